@@ -1,118 +1,133 @@
-import os
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
+import numpy as np
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
-from sqlalchemy import create_engine
+from sqlalchemy import text
 
+from core import TZ, business_hours_between_vec, get_engine, start_of_week
 
-# ----------------------------
-# Config
-# ----------------------------
-TZ = ZoneInfo("Europe/Dublin")
-WORK_START = time(9, 0)
-WORK_END = time(17, 0)
 
 st.set_page_config(page_title="Support Ticket Executive Reporting", layout="wide")
 st.title("Support Ticket Executive Reporting")
 
-DATABASE_URL = os.environ["DATABASE_URL"]
-
-# Make the driver explicit if you used psycopg v3
-# (If your DATABASE_URL already starts with postgresql+psycopg:// this is fine too)
-if DATABASE_URL.startswith("postgresql://"):
-    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
-
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=1800,
-    connect_args={"connect_timeout": 10},
-)
+# One engine (and connection pool) per server process, shared by all sessions/reruns
+engine = st.cache_resource(get_engine)()
 
 
 # ----------------------------
-# Business hours calculator (Mon–Fri 09:00–17:00, Europe/Dublin)
+# Data loading
 # ----------------------------
-def business_hours_between(start: datetime, end: datetime) -> float:
-    """
-    Business hours between two timezone-aware datetimes.
-    Counts Mon–Fri 09:00–17:00 only (no lunch subtraction).
-    """
-    if pd.isna(start) or pd.isna(end) or end <= start:
-        return 0.0
-
-    start = start.astimezone(TZ)
-    end = end.astimezone(TZ)
-
-    total = 0.0
-    cur = start
+@st.cache_data(ttl=300)
+def load_data():
+    owners = pd.read_sql("select owner_id, full_name from owners", engine)
+    weekly = pd.read_sql("select * from weekly_metrics", engine)
 
-    while cur.date() <= end.date():
-        # Skip weekends
-        if cur.weekday() >= 5:  # Sat/Sun
-            cur = (cur.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
-            continue
+    weekly["week_start"] = pd.to_datetime(weekly.get("week_start"), errors="coerce")
 
-        day_start = datetime.combine(cur.date(), WORK_START, tzinfo=TZ)
-        day_end = datetime.combine(cur.date(), WORK_END, tzinfo=TZ)
+    # Normalize ids/types (categoricals: cheap equality masks on every rerun)
+    owners["owner_id"] = owners["owner_id"].astype(str)
+    weekly["category"] = weekly["category"].astype("category")
+    weekly["owner_id"] = weekly["owner_id"].astype(str)
 
-        window_start = max(day_start, start)
-        window_end = min(day_end, end)
+    # Agent names resolved once per load, not on every rerun
+    owner_map = dict(zip(owners["owner_id"].to_numpy(), owners["full_name"].to_numpy()))
+    weekly["owner_name"] = weekly["owner_id"].map(owner_map).fillna("Unassigned").astype("category")
 
-        if window_end > window_start:
-            total += (window_end - window_start).total_seconds() / 3600.0
+    return owners, weekly
 
-        cur = (cur.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
 
-    return total
+owners, weekly = load_data()
 
 
 # ----------------------------
-# Data loading
+# Period queries (aggregated in Postgres)
 # ----------------------------
-@st.cache_data(ttl=300)
-def load_data():
-    tickets = pd.read_sql("select * from tickets_snapshot", engine)
-    owners = pd.read_sql("select * from owners", engine)
-    weekly = pd.read_sql("select * from weekly_metrics", engine)
-
-    # Parse datetimes (stored as timestamptz, but ensure UTC in pandas)
-    tickets["created_at"] = pd.to_datetime(tickets.get("created_at"), utc=True, errors="coerce")
-    tickets["closed_at"] = pd.to_datetime(tickets.get("closed_at"), utc=True, errors="coerce")
-    tickets["updated_at"] = pd.to_datetime(tickets.get("updated_at"), utc=True, errors="coerce")
+# Tickets with the same normalisation the report applies everywhere:
+# - missing category -> "Uncategorised", unknown/missing owner -> "Unassigned" (owner_name, from tickets_enriched)
+# - closed_effective_at is a generated column on tickets_snapshot (see jobs/fetch_hubspot.py)
+TICKETS_CTE = """
+with t as (
+    select
+        ticket_id,
+        coalesce(category, 'Uncategorised') as category,
+        owner_name,
+        created_at,
+        is_closed,
+        closed_effective_at
+    from tickets_enriched
+    where (cast(:category as text) is null or coalesce(category, 'Uncategorised') = :category)
+      and (cast(:agent as text) is null or owner_name = :agent)
+)
+"""
 
-    weekly["week_start"] = pd.to_datetime(weekly.get("week_start"), errors="coerce")
+# Opened in period / closed in period /
+# backlog at end of period: created before end AND not closed before end OR not in closed stage
+PERIOD_COUNTS = """
+    count(*) filter (where created_at >= :start_utc and created_at < :end_utc) as opened,
+    count(*) filter (where is_closed and closed_effective_at >= :start_utc and closed_effective_at < :end_utc) as closed,
+    count(*) filter (
+        where created_at < :end_utc
+          and (closed_effective_at is null or closed_effective_at >= :end_utc or not is_closed)
+    ) as backlog
+"""
+
+CATEGORY_SQL = TICKETS_CTE + f"""
+select category, {PERIOD_COUNTS}
+from t
+group by category
+"""
+
+AGENT_SQL = TICKETS_CTE + f"""
+select owner_name, {PERIOD_COUNTS}
+from t
+group by owner_name
+"""
+
+CLOSED_SQL = TICKETS_CTE + """
+select ticket_id, category, owner_name, created_at, closed_effective_at
+from t
+where is_closed and closed_effective_at >= :start_utc and closed_effective_at < :end_utc
+"""
+
+FILTER_OPTIONS_SQL = """
+select distinct coalesce(category, 'Uncategorised') as category, owner_name
+from tickets_enriched
+"""
 
-    # Normalize ids/types
-    if "owner_id" in tickets.columns:
-        tickets["owner_id"] = tickets["owner_id"].fillna("Unassigned").astype(str)
-    else:
-        tickets["owner_id"] = "Unassigned"
 
-    if "category" in tickets.columns:
-        tickets["category"] = tickets["category"].fillna("Uncategorised")
-    else:
-        tickets["category"] = "Uncategorised"
+@st.cache_data(ttl=300)
+def load_filter_options():
+    opts = pd.read_sql(text(FILTER_OPTIONS_SQL), engine)
+    return sorted(opts["category"].unique().tolist()), sorted(opts["owner_name"].unique().tolist())
 
-    owners["owner_id"] = owners["owner_id"].astype(str)
 
-    return tickets, owners, weekly
+@st.cache_data(ttl=300)
+def run_period_query(sql: str, start_utc: datetime, end_utc: datetime, category, agent) -> pd.DataFrame:
+    """
+    Runs one of the period queries above; cached per filter tuple.
+    category/agent of None means "All".
+    """
+    params = {"start_utc": start_utc, "end_utc": end_utc, "category": category, "agent": agent}
+    return pd.read_sql(text(sql), engine, params=params)
 
 
-tickets, owners, weekly = load_data()
+@st.cache_data(ttl=300)
+def load_closed(start_utc: datetime, end_utc: datetime, category, agent) -> pd.DataFrame:
+    """
+    Tickets closed in the period with their resolution time in business hours.
+    """
+    closed = run_period_query(CLOSED_SQL, start_utc, end_utc, category, agent)
+    closed["created_at"] = pd.to_datetime(closed["created_at"], utc=True, errors="coerce")
+    closed["closed_effective_at"] = pd.to_datetime(closed["closed_effective_at"], utc=True, errors="coerce")
+    closed["resolution_bh_hours"] = business_hours_between_vec(closed["created_at"], closed["closed_effective_at"])
+    return closed
 
 
 # ----------------------------
 # Date range helpers (exec-friendly)
 # ----------------------------
-def start_of_week(dt: datetime) -> datetime:
-    dt = dt.astimezone(TZ).replace(hour=0, minute=0, second=0, microsecond=0)
-    return dt - timedelta(days=dt.weekday())  # Monday
-
-
 def last_week_range(now: datetime):
     this_week_start = start_of_week(now)
     prev_week_start = this_week_start - timedelta(days=7)
@@ -152,77 +167,43 @@ else:
 
 st.sidebar.caption(f"{start_dt:%Y-%m-%d} → {end_dt:%Y-%m-%d} (Europe/Dublin)")
 
+all_categories, all_agents = load_filter_options()
+
 # Category filter
-categories = ["All"] + sorted(tickets["category"].unique().tolist())
+categories = ["All"] + all_categories
 sel_cat = st.sidebar.selectbox("Category", categories)
 
 # Agent filter
-owner_map = owners.set_index("owner_id")["full_name"].to_dict()
-tickets["owner_name"] = tickets["owner_id"].map(owner_map).fillna("Unassigned")
-agents = ["All"] + sorted(tickets["owner_name"].unique().tolist())
+agents = ["All"] + all_agents
 sel_agent = st.sidebar.selectbox("Agent", agents)
 
-# Apply filters
-t = tickets.copy()
-if sel_cat != "All":
-    t = t[t["category"] == sel_cat]
-if sel_agent != "All":
-    t = t[t["owner_name"] == sel_agent]
-
-# Build effective close time:
-# - use closed_at when present
-# - else (closed stage) fallback to updated_at (hs_lastmodifieddate) as proxy
-t["closed_effective_at"] = t["closed_at"]
-mask_fallback = t["closed_effective_at"].isna() & (t.get("is_closed", False) == True)
-t.loc[mask_fallback, "closed_effective_at"] = t.loc[mask_fallback, "updated_at"]
-
 # Selected period window in UTC for comparisons
 start_utc = start_dt.astimezone(ZoneInfo("UTC"))
 end_utc = end_dt.astimezone(ZoneInfo("UTC"))
 
-# ----------------------------
-# Period slices
-# ----------------------------
-opened = t[(t["created_at"] >= start_utc) & (t["created_at"] < end_utc)]
-
-closed = t[
-    (t.get("is_closed", False) == True)
-    & (t["closed_effective_at"].notna())
-    & (t["closed_effective_at"] >= start_utc)
-    & (t["closed_effective_at"] < end_utc)
-]
-
-# backlog at end of period: created before end AND not closed before end OR not in closed stage
-backlog = t[
-    (t["created_at"] < end_utc)
-    & ((t["closed_effective_at"].isna()) | (t["closed_effective_at"] >= end_utc) | (t.get("is_closed", False) == False))
-]
+filters = (
+    start_utc,
+    end_utc,
+    None if sel_cat == "All" else sel_cat,
+    None if sel_agent == "All" else sel_agent,
+)
 
 # ----------------------------
-# Resolution time (business hours) for closed tickets in period
+# Period counts + closed tickets (with resolution time in business hours)
 # ----------------------------
-if len(closed) > 0:
-    closed = closed.copy()
-    closed["resolution_bh_hours"] = closed.apply(
-        lambda r: business_hours_between(
-            r["created_at"].to_pydatetime(),
-            r["closed_effective_at"].to_pydatetime(),
-        ),
-        axis=1,
-    )
-    closed["resolution_bh_hours"] = pd.to_numeric(closed["resolution_bh_hours"], errors="coerce")
-else:
-    closed = closed.copy()
-    closed["resolution_bh_hours"] = pd.Series(dtype="float")
+# One grouped pass gives the category table; the KPI totals are its column sums
+cat_counts = run_period_query(CATEGORY_SQL, *filters).set_index("category")
+kpis = cat_counts.sum()
+closed = load_closed(*filters)
 
 
 # ----------------------------
 # KPI tiles
 # ----------------------------
 k1, k2, k3, k4, k5 = st.columns(5)
-k1.metric("Opened", len(opened))
-k2.metric("Closed", len(closed))
-k3.metric("Backlog (end of period)", len(backlog))
+k1.metric("Opened", int(kpis["opened"]))
+k2.metric("Closed", int(kpis["closed"]))
+k3.metric("Backlog (end of period)", int(kpis["backlog"]))
 
 if closed["resolution_bh_hours"].notna().any():
     med = float(closed["resolution_bh_hours"].median())
@@ -240,13 +221,8 @@ st.divider()
 # Categories table
 # ----------------------------
 st.subheader("Categories")
-cat_tbl = pd.DataFrame(
-    {
-        "Opened": opened["category"].value_counts(),
-        "Closed": closed["category"].value_counts(),
-        "Backlog": backlog["category"].value_counts(),
-    }
-).fillna(0).astype(int).sort_values(by=["Backlog", "Opened"], ascending=False)
+cat_tbl = cat_counts.rename(columns={"opened": "Opened", "closed": "Closed", "backlog": "Backlog"})
+cat_tbl = cat_tbl[cat_tbl.any(axis=1)].astype(int).sort_values(by=["Backlog", "Opened"], ascending=False)
 
 st.dataframe(cat_tbl, use_container_width=True)
 
@@ -257,18 +233,15 @@ st.divider()
 # Trends (weekly) – uses precomputed weekly_metrics
 # ----------------------------
 st.subheader("Trends (weekly)")
-w = weekly.copy()
+mask = np.ones(len(weekly), dtype=bool)
 
 if sel_cat != "All":
-    w = w[w["category"] == sel_cat]
+    mask &= (weekly["category"] == sel_cat).to_numpy()
 
 if sel_agent != "All":
-    # Map selected agent back to owner_id(s)
-    owner_ids = owners.loc[owners["full_name"] == sel_agent, "owner_id"].astype(str).tolist()
-    if owner_ids:
-        w = w[w["owner_id"].astype(str).isin(owner_ids)]
-    else:
-        w = w.iloc[0:0]  # empty
+    mask &= (weekly["owner_name"] == sel_agent).to_numpy()
+
+w = weekly[mask]
 
 trend = (
     w.groupby("week_start")
@@ -286,18 +259,17 @@ trend = (
 if len(trend) == 0:
     st.info("No weekly trend data found for the selected filters.")
 else:
-    fig = plt.figure()
-    plt.plot(trend["week_start"], trend["opened"], label="Opened")
-    plt.plot(trend["week_start"], trend["closed"], label="Closed")
-    plt.plot(trend["week_start"], trend["backlog"], label="Backlog")
-    plt.legend()
-    st.pyplot(fig, clear_figure=True)
-
-    fig2 = plt.figure()
-    plt.plot(trend["week_start"], trend["median_bh"], label="Median resolution (bh)")
-    plt.plot(trend["week_start"], trend["p90_bh"], label="P90 resolution (bh)")
-    plt.legend()
-    st.pyplot(fig2, clear_figure=True)
+    trend = trend.set_index("week_start")
+    st.line_chart(
+        trend[["opened", "closed", "backlog"]].rename(
+            columns={"opened": "Opened", "closed": "Closed", "backlog": "Backlog"}
+        )
+    )
+    st.line_chart(
+        trend[["median_bh", "p90_bh"]].rename(
+            columns={"median_bh": "Median resolution (bh)", "p90_bh": "P90 resolution (bh)"}
+        )
+    )
 
 st.divider()
 
@@ -306,19 +278,19 @@ st.divider()
 # Agent activity (selected period)
 # ----------------------------
 st.subheader("Agent activity (selected period)")
+agent_counts = run_period_query(AGENT_SQL, *filters).set_index("owner_name")
+agent_counts = agent_counts[(agent_counts["closed"] > 0) | (agent_counts["backlog"] > 0)]
 agent_tbl = (
-    closed.groupby("owner_name")
-    .agg(
-        Closed=("ticket_id", "count"),
-        Median_resolution_bh=("resolution_bh_hours", "median"),
-        P90_resolution_bh=("resolution_bh_hours", lambda s: s.quantile(0.9) if len(s.dropna()) else float("nan")),
+    agent_counts[["closed"]].astype(int).rename(columns={"closed": "Closed"})
+    .join(
+        closed.groupby("owner_name")["resolution_bh_hours"].quantile([0.5, 0.9])
+        .unstack()
+        .reindex(columns=[0.5, 0.9])
+        .rename(columns={0.5: "Median_resolution_bh", 0.9: "P90_resolution_bh"})
     )
-    .join(backlog.groupby("owner_name").size().to_frame("Assigned backlog"), how="outer")
+    .join(agent_counts["backlog"].astype(int).rename("Assigned backlog"))
 )
 
-agent_tbl["Closed"] = agent_tbl["Closed"].fillna(0).astype(int)
-agent_tbl["Assigned backlog"] = agent_tbl["Assigned backlog"].fillna(0).astype(int)
-
 # Format numeric cols
 for col in ["Median_resolution_bh", "P90_resolution_bh"]:
     if col in agent_tbl.columns:
@@ -0,0 +1,123 @@
+"""
+Shared config and helpers for the dashboard (app.py) and the refresh jobs (jobs/).
+"""
+import io
+import os
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+
+# ----------------------------
+# Config
+# ----------------------------
+TZ = ZoneInfo("Europe/Dublin")
+WORK_START = time(9, 0)
+WORK_END = time(17, 0)
+
+# Working days for business-hours maths; add Irish bank holidays ("YYYY-MM-DD") to exclude them
+IE_HOLIDAYS: list[str] = []
+BUSDAY_CAL = np.busdaycalendar(weekmask="1111100", holidays=IE_HOLIDAYS)
+
+
+# ----------------------------
+# Database
+# ----------------------------
+def get_engine():
+    """
+    SQLAlchemy engine for DATABASE_URL (psycopg v3 driver) with an explicitly sized pool.
+    The app wraps this in st.cache_resource so one pool is shared by all sessions/reruns.
+    """
+    url = os.environ["DATABASE_URL"]
+
+    # Make the driver explicit: COPY and the app both rely on psycopg v3
+    # (If your DATABASE_URL already starts with postgresql+psycopg:// this is fine too)
+    if url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+psycopg://", 1)
+
+    # LIFO keeps the pool small when idle; pre-ping drops connections killed by idle timeouts.
+    return create_engine(
+        url,
+        pool_size=10,
+        max_overflow=20,
+        pool_timeout=30,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+        pool_use_lifo=True,
+        connect_args={"connect_timeout": 10},
+    )
+
+
+def copy_frame(conn, table: str, df: pd.DataFrame) -> None:
+    """
+    Bulk load df into table via COPY ... FROM STDIN (psycopg v3) rather than multi-row INSERTs.
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    cols = ", ".join(df.columns)
+    with conn.connection.driver_connection.cursor() as cur:
+        with cur.copy(f"copy {table} ({cols}) from stdin with (format csv)") as copy:
+            copy.write(buf.getvalue())
+
+
+# ----------------------------
+# Business hours calculator (Mon–Fri 09:00–17:00, Europe/Dublin)
+# ----------------------------
+def business_hours_between_vec(start: pd.Series, end: pd.Series) -> np.ndarray:
+    """
+    Business hours between two Series of timezone-aware timestamps, row by row.
+    Counts Mon–Fri 09:00–17:00 only (no lunch subtraction).
+    """
+    out = np.zeros(len(start), dtype="float64")
+    valid = (start.notna() & end.notna() & (end > start)).to_numpy()
+    if not valid.any():
+        return out
+
+    # Local wall-clock times as int64 ns: day and time-of-day are plain integer arithmetic
+    day_ns = 86_400_000_000_000
+    open_ns = (WORK_START.hour * 60 + WORK_START.minute) * 60 * 1_000_000_000
+    close_ns = (WORK_END.hour * 60 + WORK_END.minute) * 60 * 1_000_000_000
+    start_ns = start[valid].dt.tz_convert(TZ).dt.tz_localize(None).to_numpy(dtype="datetime64[ns]").view("int64")
+    end_ns = end[valid].dt.tz_convert(TZ).dt.tz_localize(None).to_numpy(dtype="datetime64[ns]").view("int64")
+
+    # Clip each timestamp into the working window of its own day
+    start_day, start_tod = np.divmod(start_ns, day_ns)
+    end_day, end_tod = np.divmod(end_ns, day_ns)
+    start_tod = start_tod.clip(open_ns, close_ns)
+    end_tod = end_tod.clip(open_ns, close_ns)
+
+    start_date = start_day.astype("datetime64[D]")
+    end_date = end_day.astype("datetime64[D]")
+    start_is_bd = np.is_busday(start_date, busdaycal=BUSDAY_CAL)
+    end_is_bd = np.is_busday(end_date, busdaycal=BUSDAY_CAL)
+
+    # Same day: clipped difference. Otherwise: head of start day + whole days between + tail of end day
+    same = start_day == end_day
+    same_day = (end_tod - start_tod).clip(min=0)
+    head = close_ns - start_tod
+    tail = end_tod - open_ns
+
+    # Most tickets close the day they are opened: only count whole days for the rest
+    whole_days = np.zeros(len(same), dtype="int64")
+    if not same.all():
+        whole_days[~same] = np.busday_count(start_date[~same] + 1, end_date[~same], busdaycal=BUSDAY_CAL)
+
+    total_ns = np.where(
+        same,
+        np.where(start_is_bd, same_day, 0),
+        np.where(start_is_bd, head, 0) + whole_days * (close_ns - open_ns) + np.where(end_is_bd, tail, 0),
+    )
+    out[valid] = total_ns / 3.6e12
+    return out
+
+
+# ----------------------------
+# Date helpers
+# ----------------------------
+def start_of_week(dt: datetime) -> datetime:
+    dt = dt.astimezone(TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt - timedelta(days=dt.weekday())  # Monday
+
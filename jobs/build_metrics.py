@@ -1,116 +1,90 @@
-import os
+import numpy as np
 import pandas as pd
-from datetime import datetime, time, timedelta
-from zoneinfo import ZoneInfo
-from sqlalchemy import create_engine, text
+from datetime import datetime, timedelta
+from sqlalchemy import text
 
-DATABASE_URL = os.environ["DATABASE_URL"]
-
-TZ = ZoneInfo("Europe/Dublin")
-WORK_START = time(9, 0)
-WORK_END = time(17, 0)
-
-def business_hours_between(start: datetime, end: datetime) -> float:
-    if pd.isna(start) or pd.isna(end) or end <= start:
-        return 0.0
-
-    start = start.astimezone(TZ)
-    end = end.astimezone(TZ)
-
-    total = 0.0
-    cur = start
-
-    while cur.date() <= end.date():
-        if cur.weekday() >= 5:  # Sat/Sun
-            cur = (cur.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
-            continue
-
-        day_start = datetime.combine(cur.date(), WORK_START, tzinfo=TZ)
-        day_end = datetime.combine(cur.date(), WORK_END, tzinfo=TZ)
-
-        window_start = max(day_start, start)
-        window_end = min(day_end, end)
-
-        if window_end > window_start:
-            total += (window_end - window_start).total_seconds() / 3600.0
-
-        cur = (cur.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
-
-    return total
-
-def week_start(dt: datetime) -> datetime:
-    dt = dt.astimezone(TZ)
-    monday = (dt - timedelta(days=dt.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-    return monday
+from core import TZ, business_hours_between_vec, copy_frame, get_engine, start_of_week
 
 def build_weekly_metrics(df: pd.DataFrame, weeks_back: int = 26) -> pd.DataFrame:
     now = datetime.now(TZ)
-    start = week_start(now) - timedelta(days=7 * weeks_back)
-    end = week_start(now)
+    start = start_of_week(now) - timedelta(days=7 * weeks_back)
 
     df["created_at"] = pd.to_datetime(df["created_at"], utc=True, errors="coerce")
     df["closed_at"] = pd.to_datetime(df["closed_at"], utc=True, errors="coerce")
 
-    weeks = []
-    cur = start
-    while cur < end:
-        weeks.append((cur, cur + timedelta(days=7)))
-        cur = cur + timedelta(days=7)
-
-    rows = []
-    for ws, we in weeks:
-        ws_utc = ws.astimezone(ZoneInfo("UTC"))
-        we_utc = we.astimezone(ZoneInfo("UTC"))
-
-        opened = df[(df["created_at"] >= ws_utc) & (df["created_at"] < we_utc)]
-        closed = df[(df["is_closed"] == True) & (df["closed_at"].notna()) &
-                    (df["closed_at"] >= ws_utc) & (df["closed_at"] < we_utc)]
-
-        backlog = df[(df["created_at"] < we_utc) &
-                     ((df["closed_at"].isna()) | (df["closed_at"] >= we_utc) | (df["is_closed"] == False))]
-
-        if len(closed) > 0:
-            bh = closed.apply(
-                lambda r: business_hours_between(r["created_at"].to_pydatetime(), r["closed_at"].to_pydatetime()),
-                axis=1
-            )
-            closed = closed.assign(bh_close_hours=bh)
-        else:
-            closed = closed.assign(bh_close_hours=pd.Series(dtype="float"))
-
-        cats = pd.concat([
-            opened[["category","owner_id"]].assign(opened_count=1),
-            closed[["category","owner_id"]].assign(closed_count=1),
-            backlog[["category","owner_id"]].assign(backlog_end_count=1),
-        ], axis=0, ignore_index=True)
-
-        grouped = cats.groupby(["category","owner_id"], dropna=False).sum(numeric_only=True).reset_index()
-
-        if len(closed) > 0:
-            stats = closed.groupby(["category","owner_id"], dropna=False)["bh_close_hours"].agg(
-                median_bh_close_hours="median",
-                p90_bh_close_hours=lambda s: s.quantile(0.9)
-            ).reset_index()
-            grouped = grouped.merge(stats, on=["category","owner_id"], how="left")
-        else:
-            grouped["median_bh_close_hours"] = None
-            grouped["p90_bh_close_hours"] = None
-
-        grouped.insert(0, "week_start", ws.date())
-        rows.append(grouped)
-
-    out = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame()
+    keys = ["week_start", "category", "owner_id"]
+    bounds = pd.DatetimeIndex([start + timedelta(days=7 * i) for i in range(weeks_back + 1)]).tz_convert("UTC")
+    week_starts = [ws.date() for ws in bounds[:-1].tz_convert(TZ)]
+
+    # Timestamps as numpy datetime64[ns] arrays: window checks and week lookups are plain
+    # numpy comparisons / binary searches (NaT compares False and sorts after every boundary)
+    bounds_ns = bounds.to_numpy(dtype="datetime64[ns]")
+    created = df["created_at"].to_numpy(dtype="datetime64[ns]")
+    closed_at = df["closed_at"].to_numpy(dtype="datetime64[ns]")
+    is_closed = (df["is_closed"] == True).to_numpy()
+
+    # Opened / closed: week of each timestamp = last boundary at or before it
+    opened_week = np.searchsorted(bounds_ns, created, side="right") - 1
+    closed_week = np.searchsorted(bounds_ns, closed_at, side="right") - 1
+    in_opened = (opened_week >= 0) & (opened_week < weeks_back)
+    in_closed = is_closed & (closed_week >= 0) & (closed_week < weeks_back)
+
+    week_start_values = np.array(week_starts, dtype=object)
+    opened = df[in_opened].assign(week_start=week_start_values[opened_week[in_opened]])
+    closed = df[in_closed]
+    closed = closed.assign(
+        week_start=week_start_values[closed_week[in_closed]],
+        bh_close_hours=business_hours_between_vec(closed["created_at"], closed["closed_at"]),
+    )
+
+    opened_counts = opened.groupby(keys, dropna=False).size().rename("opened_count")
+    closed_counts = closed.groupby(keys, dropna=False).size().rename("closed_count")
+
+    # Backlog at each week end: a ticket is open from created_at until closed_at (if closed).
+    # Locate both events against the week-end boundaries, then cumulate +1/-1 per group.
+    week_ends = bounds_ns[1:]
+    resolved = np.where(is_closed, np.maximum(created, closed_at), np.datetime64("NaT", "ns"))
+    events = pd.concat([
+        df[["category", "owner_id"]].assign(week=np.searchsorted(week_ends, created, side="right"), delta=1),
+        df[["category", "owner_id"]].assign(
+            week=np.searchsorted(week_ends, resolved, side="right"), delta=-1
+        ),
+    ], ignore_index=True)
+    events = events[events["week"] < weeks_back]
+
+    backlog = (
+        events.groupby(["category", "owner_id", "week"], dropna=False)["delta"].sum()
+        .unstack("week", fill_value=0)
+        .reindex(columns=range(weeks_back), fill_value=0)
+        .cumsum(axis=1)
+    )
+    backlog.columns = week_starts
+    backlog_counts = (
+        backlog.melt(var_name="week_start", value_name="backlog_end_count", ignore_index=False)
+        .reset_index()
+        .set_index(keys)["backlog_end_count"]
+    )
+    backlog_counts = backlog_counts[backlog_counts > 0]
+
+    # Align the three counts on (week_start, category, owner_id) in one go
+    out = pd.concat([opened_counts, closed_counts, backlog_counts], axis=1).fillna(0).astype(int)
+
+    stats = (
+        closed.groupby(keys, dropna=False)["bh_close_hours"].quantile([0.5, 0.9])
+        .unstack()
+        .reindex(columns=[0.5, 0.9])
+        .rename(columns={0.5: "median_bh_close_hours", 0.9: "p90_bh_close_hours"})
+    )
+    out = out.join(stats).sort_index().reset_index()
+
     out["category"] = out["category"].fillna("Uncategorised")
     out["owner_id"] = out["owner_id"].fillna("Unassigned").astype(str)
     return out
 
 def main():
-    engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-)
+    engine = get_engine()
 
-    df = pd.read_sql("select * from tickets_snapshot", engine)
+    df = pd.read_sql("select created_at, closed_at, is_closed, owner_id, category from tickets_snapshot", engine)
     df["owner_id"] = df["owner_id"].fillna("Unassigned").astype(str)
     df["category"] = df["category"].fillna("Uncategorised")
 
@@ -118,7 +92,7 @@ def main():
 
     with engine.begin() as conn:
         conn.execute(text("delete from weekly_metrics"))
-        weekly.to_sql("weekly_metrics", conn, if_exists="append", index=False, method="multi")
+        copy_frame(conn, "weekly_metrics", weekly)
 
     print(f"Built weekly_metrics rows: {len(weekly)}")
 